@@ -1,11 +1,17 @@
 import os
-import json
+import argparse
 import time
 import asyncio
-import requests
+import hashlib
+import html
+import socket
+import sqlite3
+import httpx
+import orjson
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import AIORateLimiter, Application, CommandHandler, CallbackQueryHandler, ContextTypes
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -22,150 +28,517 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_IDS = [cid.strip() for cid in os.getenv('TELEGRAM_CHAT_IDS', '').split(',') if cid.strip()]
 CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', 900))
-SENT_POSTS_FILE = 'sent_posts.json'
+MIN_CHECK_INTERVAL = int(os.getenv('MIN_CHECK_INTERVAL', 60))
+# At startup, record every post on all MAX_PAGES pages as sent without delivering it (for seeding)
+FULL_SCAN = os.getenv('FULL_SCAN', '').lower() in ('1', 'true', 'yes')
+SENT_POSTS_DB = os.getenv('SENT_POSTS_DB', 'sent_posts.db')
+# Sent tokens saved by earlier versions, imported into the database on first start
+LEGACY_SENT_POSTS_FILE = os.path.join(os.path.dirname(SENT_POSTS_DB), 'sent_posts.json')
+# Number of most recent sent tokens remembered; Divar tokens never recur once they're this old
+SENT_POSTS_LIMIT = int(os.getenv('SENT_POSTS_LIMIT', 100_000))
+MAX_PAGES = 5  # Upper bound on result pages fetched per check
+ALBUM_SIZE = 10  # Telegram's limit on photos per media group
+MAX_SEND_RETRIES = 3  # Re-sends after Telegram flood control before giving up
+MAX_DELIVERY_ATTEMPTS = 3  # Tries at delivering a post before it is given up on
+DELIVERY_RETRY_DELAY = 60  # Seconds before failed posts are tried again
+SENT_POSTS_FLUSH_INTERVAL = 5  # Seconds between writes of newly sent tokens
 
 # Divar API configuration
 DIVAR_API_URL = "https://api.divar.ir/v8/web-search/5/residential-rent"
+DIVAR_POST_URL = "https://divar.ir/v/"
+POST_TEMPLATE = "🏠 <b>{title}</b>\n\n{district}{description}\n🔗 <a href='{url}'>View Post</a>"
+DIVAR_RETRIES = 3
+FIRST_PAGE_CACHE_TTL = 30  # Seconds a first-page result is reused by back-to-back checks
+DIVAR_RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Answers to a matching If-None-Match: 304, or 412 since the search is a POST (RFC 9110)
+DIVAR_UNCHANGED_STATUSES = {304, 412}
+HEADERS = {
+    'Content-Type': 'application/json',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+}
 API_PAYLOAD = {
     "json_schema": {
         "category": {"value": "residential-rent"},
         "cities": ["5"]
     },
-    "last-post-date": int(time.time() * 1000)  # Current timestamp in milliseconds
+    "last-post-date": "__TS__"  # Filled per request with a timestamp in milliseconds
 }
+# Serialized once and split around the timestamp, which is the only part that varies per request
+PAYLOAD_PREFIX, PAYLOAD_SUFFIX = orjson.dumps(API_PAYLOAD).split(b'"__TS__"')
+
+
+# Caps concurrent Telegram sends when fanning a post out to all chats
+SEND_SEMAPHORE = asyncio.Semaphore(10)
+
+# Sends rejected by Telegram's flood control, re-sent later by retry_worker
+RETRY_QUEUE = asyncio.Queue()
+# Pending retry_send tasks started by retry_worker, cancelled on shutdown
+RETRY_TASKS = set()
+
+# New posts waiting for delivery_worker; checks only enqueue, so slow sends never hold them up
+DELIVERY_QUEUE = asyncio.Queue(maxsize=200)
+
+# Keys (see token_key) of posts already sent, oldest first, loaded once at startup;
+# the database keeps the full tokens
+SENT_POSTS = {}
+# Tokens of delivered posts not yet flushed to the database
+PENDING_SENT_POSTS = []
+# Posts handed to delivery_worker but not yet delivered (or given up on), by token;
+# saved on shutdown and queued again on the next start
+UNDELIVERED_POSTS = {}
+
+# Persistent store of sent tokens, opened by main(); rowid keeps insertion order
+DB = None
+
+def token_key(token):
+    """64-bit hash of a post token, used as the compact in-memory dedup key"""
+    return int.from_bytes(hashlib.blake2b(token.encode(), digest_size=8).digest(), 'little')
 
 def load_sent_posts():
-    """Load sent post tokens from file"""
+    """Load the most recent sent post tokens from the database"""
     try:
-        if os.path.exists(SENT_POSTS_FILE):
-            with open(SENT_POSTS_FILE, 'r') as f:
-                return set(json.load(f))
-    except Exception as e:
+        DB.execute('PRAGMA journal_mode=WAL')
+        DB.execute('PRAGMA synchronous=NORMAL')
+        with DB:
+            DB.execute('CREATE TABLE IF NOT EXISTS sent_posts (token TEXT PRIMARY KEY)')
+            DB.execute('CREATE TABLE IF NOT EXISTS undelivered_posts (token TEXT PRIMARY KEY, post BLOB)')
+            prune_sent_posts()
+        tokens = [token for (token,) in DB.execute('SELECT token FROM sent_posts ORDER BY rowid')]
+        if not tokens:
+            tokens = load_legacy_sent_posts()[-SENT_POSTS_LIMIT:]
+            append_sent_posts(tokens)
+        return dict.fromkeys(map(token_key, tokens))
+    except (sqlite3.Error, OSError, ValueError) as e:
         logger.error(f"Error loading sent posts: {e}")
-    return set()
+    return {}
+
+def load_legacy_sent_posts():
+    """Read tokens from a sent_posts.json left by earlier versions"""
+    if os.path.exists(LEGACY_SENT_POSTS_FILE):
+        with open(LEGACY_SENT_POSTS_FILE, 'rb') as f:
+            return orjson.loads(f.read())
+    return []
+
+def prune_sent_posts():
+    """Delete database rows beyond the newest SENT_POSTS_LIMIT tokens; they are too old to show up again"""
+    DB.execute(
+        'DELETE FROM sent_posts WHERE rowid <= (SELECT MAX(rowid) FROM sent_posts) - ?',
+        (SENT_POSTS_LIMIT,)
+    )
+
+def trim_sent_posts(sent_posts):
+    """Evict the oldest tokens beyond SENT_POSTS_LIMIT from the in-memory store"""
+    while len(sent_posts) > SENT_POSTS_LIMIT:
+        del sent_posts[next(iter(sent_posts))]
 
-def save_sent_posts(sent_posts):
-    """Save sent post tokens to file"""
+def append_sent_posts(tokens):
+    """Insert newly sent post tokens into the database in one transaction"""
     try:
-        with open(SENT_POSTS_FILE, 'w') as f:
-            json.dump(list(sent_posts), f)
-    except Exception as e:
+        with DB:
+            DB.executemany('INSERT OR IGNORE INTO sent_posts (token) VALUES (?)', ((token,) for token in tokens))
+            prune_sent_posts()
+    except sqlite3.Error as e:
         logger.error(f"Error saving sent posts: {e}")
 
-def search_divar(last_post_date=None):
+def flush_sent_posts():
+    """Write pending tokens to the database, if any"""
+    if PENDING_SENT_POSTS:
+        append_sent_posts(PENDING_SENT_POSTS)
+        PENDING_SENT_POSTS.clear()
+
+def load_undelivered_posts():
+    """Take the posts left undelivered by the last run from the database, oldest first"""
+    try:
+        with DB:
+            posts = [orjson.loads(post) for (post,) in DB.execute('SELECT post FROM undelivered_posts ORDER BY rowid')]
+            DB.execute('DELETE FROM undelivered_posts')
+        return posts
+    except (sqlite3.Error, ValueError) as e:
+        logger.error(f"Error loading undelivered posts: {e}")
+    return []
+
+def save_undelivered_posts():
+    """Store posts still waiting for delivery, so the next run sends them"""
+    try:
+        with DB:
+            DB.executemany(
+                'INSERT OR REPLACE INTO undelivered_posts (token, post) VALUES (?, ?)',
+                ((token, orjson.dumps(post)) for token, post in UNDELIVERED_POSTS.items())
+            )
+    except sqlite3.Error as e:
+        logger.error(f"Error saving undelivered posts: {e}")
+
+# Digest of the last first-page response, used to skip unchanged polls
+_last_first_page_digest = None
+# (monotonic fetch time, result) of the last first-page search, reused for FIRST_PAGE_CACHE_TTL
+_first_page_cache = None
+# ETag Divar sent with the last first page, if any, for a conditional request next time
+_first_page_etag = None
+
+def create_http_client():
+    """Create the shared async HTTP client for Divar.
+    
+    It keeps Divar requests off the blocking path of the bot's event loop and
+    reuses the connection to Divar across pages and checks.
+    """
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=60),
+            retries=3,
+            socket_options=[
+                (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            ]
+        ),
+        timeout=30.0,
+        headers=HEADERS
+    )
+
+async def search_divar(client, last_post_date=None):
     """Search for posts on Divar"""
-    payload = API_PAYLOAD.copy()
-    if last_post_date:
-        payload["last-post-date"] = last_post_date
+    global _last_first_page_digest, _first_page_cache, _first_page_etag
+    
+    # Only the first page is cached and skipped when unchanged
+    first_page = last_post_date is None
+    
+    # Checks in quick succession (e.g. repeated button presses) reuse the recent first page
+    if first_page and _first_page_cache and time.monotonic() - _first_page_cache[0] < FIRST_PAGE_CACHE_TTL:
+        return _first_page_cache[1]
+    
+    timestamp = last_post_date or int(time.time() * 1000)
+    body = b''.join((PAYLOAD_PREFIX, str(timestamp).encode(), PAYLOAD_SUFFIX))
+    headers = {'If-None-Match': _first_page_etag} if first_page and _first_page_etag else None
     
     try:
-        headers = {
-            'Content-Type': 'application/json',
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
-        response = requests.post(DIVAR_API_URL, json=payload, headers=headers, timeout=30)
-        response.raise_for_status()
-        return response.json()
+        # Retry throttling and transient server errors with exponential backoff
+        for attempt in range(DIVAR_RETRIES + 1):
+            response = await client.post(DIVAR_API_URL, content=body, headers=headers)
+            if response.status_code not in DIVAR_RETRY_STATUSES or attempt == DIVAR_RETRIES:
+                break
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        if response.status_code not in DIVAR_UNCHANGED_STATUSES:
+            response.raise_for_status()
+        
+        if not first_page:
+            return orjson.loads(response.content)
+        
+        # Skip decoding when the first page is unchanged: either Divar says so (304/412)
+        # or the body is byte-for-byte the same as last time
+        _first_page_etag = response.headers.get('ETag', _first_page_etag)
+        if (response.status_code in DIVAR_UNCHANGED_STATUSES
+                or (digest := hashlib.blake2b(response.content, digest_size=8).digest()) == _last_first_page_digest):
+            logger.info("Divar results unchanged since last check")
+            result = {}
+        else:
+            _last_first_page_digest = digest
+            result = orjson.loads(response.content)
+        _first_page_cache = (time.monotonic(), result)
+        return result
     except Exception as e:
         logger.error(f"Error fetching data from Divar: {e}")
         return None
 
+def has_photo(post_data):
+    """Whether the post has an image Telegram can fetch by URL"""
+    image_url = post_data.get('image_url')
+    return bool(image_url) and image_url.startswith('http')
+
+def render_post(post_data):
+    """Build the HTML message for a post, returned with its photo URL (None if it has no usable photo)"""
+    district = post_data.get('district')
+    description = post_data.get('description')
+    
+    # Divar fields are user-supplied, so escape them for Telegram's HTML parse mode
+    message = POST_TEMPLATE.format_map({
+        'title': html.escape(post_data.get('title') or 'No title'),
+        'district': f"📍 {html.escape(district)}\n" if district else '',
+        'description': f"📝 {html.escape(description)}\n" if description else '',
+        'url': html.escape(DIVAR_POST_URL + post_data['token'])
+    })
+    return message, post_data['image_url'] if has_photo(post_data) else None
+
+def is_chat_error(error):
+    """Whether a send failed because of the chat (bot blocked or removed, chat gone) rather than the message"""
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and 'chat not found' in error.message.lower())
+
+async def send_limited(chat_id, send, attempt=0, source=False):
+    """Run send(chat_id) with bounded concurrency; returns its result, or None if it failed.
+    
+    Telegram's rate limits are applied by the bot's AIORateLimiter. Sends that
+    still hit flood control are queued for retry_worker instead of being dropped.
+    A post's first send (source=True) is instead retried here so the caller gets
+    the final result, and errors not specific to the chat are raised, since
+    another chat would reject the message too.
+    """
+    try:
+        async with SEND_SEMAPHORE:
+            return await send(chat_id)
+    except RetryAfter as e:
+        if attempt < MAX_SEND_RETRIES:
+            retry_after = getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)()
+            logger.warning(f"Rate limited sending to {chat_id}, retrying in {retry_after}s")
+            if source:
+                await asyncio.sleep(max(retry_after, 2 ** (attempt + 1)))
+                return await send_limited(chat_id, send, attempt + 1, source=True)
+            RETRY_QUEUE.put_nowait((chat_id, send, attempt + 1, retry_after))
+        else:
+            logger.error(f"Giving up sending to {chat_id} after {attempt} retries: {e}")
+        return None
+    except Exception as e:
+        if source and not is_chat_error(e):
+            raise
+        logger.error(f"Error sending to {chat_id}: {e}")
+        return None
+
+async def retry_send(chat_id, send, attempt, retry_after):
+    """Re-send a queued send after Telegram's retry_after, backing off exponentially"""
+    await asyncio.sleep(max(retry_after, 2 ** attempt))
+    await send_limited(chat_id, send, attempt)
+
+async def retry_worker():
+    """Start each queued retry as its own task, so one chat's wait doesn't delay the others"""
+    while True:
+        task = asyncio.create_task(retry_send(*await RETRY_QUEUE.get()))
+        RETRY_TASKS.add(task)
+        task.add_done_callback(RETRY_TASKS.discard)
+        RETRY_QUEUE.task_done()
+
+async def send_to_chats(bot, chat_ids, send):
+    """Deliver send(chat_id) to the first chat that accepts it, then copy it to the other chats.
+    
+    Copies are cheaper for Telegram than fresh sends: photos are reused from the
+    first delivery instead of being fetched from Divar once per chat.
+    Returns True if at least one chat received it; raises if the message itself was rejected.
+    """
+    remaining = list(chat_ids)
+    sent = None
+    while remaining and not sent:
+        source_chat_id = remaining.pop(0)
+        # Waits out flood control, so the result says whether the post was really delivered;
+        # only moves on to the next chat when this one can't receive messages
+        sent = await send_limited(source_chat_id, send, source=True)
+    if not sent:
+        return False
+    
+    # send_media_group returns a tuple of messages, the other sends a single one
+    message_ids = [message.message_id for message in (sent if isinstance(sent, tuple) else (sent,))]
+    
+    async def _copy(chat_id):
+        return await bot.copy_messages(chat_id=chat_id, from_chat_id=source_chat_id, message_ids=message_ids)
+    
+    await asyncio.gather(*[send_limited(chat_id, _copy) for chat_id in remaining])
+    return True
+
 async def send_telegram_message(bot, post_data, chat_ids):
     """Send post to Telegram users"""
     try:
-        token = post_data.get('token')
-        title = post_data.get('title', 'No title')
-        image_url = post_data.get('image_url')
-        
-        # Extract description information
-        description = post_data.get('description', '')
-        district = post_data.get('district', '')
+        # Rendered once, shared by every chat's send
+        message, photo_url = render_post(post_data)
         
-        post_url = f"https://divar.ir/v/{token}"
+        async def _send(chat_id):
+            if photo_url:
+                return await bot.send_photo(
+                    chat_id=chat_id,
+                    photo=photo_url,
+                    caption=message,
+                    parse_mode='HTML'
+                )
+            else:
+                return await bot.send_message(
+                    chat_id=chat_id,
+                    text=message,
+                    parse_mode='HTML'
+                )
         
-        message = f"🏠 <b>{title}</b>\n\n"
-        if district:
-            message += f"📍 {district}\n"
-        if description:
-            message += f"📝 {description}\n"
-        message += f"\n🔗 <a href='{post_url}'>View Post</a>"
+        return await send_to_chats(bot, chat_ids, _send)
+    except Exception as e:
+        logger.error(f"Error sending to Telegram: {e}")
+        return False
+
+async def send_media_group(bot, posts, chat_ids):
+    """Send several photo posts to Telegram users as one album"""
+    try:
+        media = []
+        for post in posts:
+            message, photo_url = render_post(post)
+            media.append(InputMediaPhoto(media=photo_url, caption=message, parse_mode='HTML'))
         
-        success_count = 0
-        for chat_id in chat_ids:
-            try:
-                if image_url and image_url.startswith('http'):
-                    await bot.send_photo(
-                        chat_id=chat_id,
-                        photo=image_url,
-                        caption=message,
-                        parse_mode='HTML'
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=chat_id,
-                        text=message,
-                        parse_mode='HTML'
-                    )
-                success_count += 1
-                await asyncio.sleep(0.5)
-            except Exception as e:
-                logger.error(f"Error sending to {chat_id}: {e}")
+        async def _send(chat_id):
+            return await bot.send_media_group(chat_id=chat_id, media=media)
         
-        return success_count > 0
+        return await send_to_chats(bot, chat_ids, _send)
     except Exception as e:
-        logger.error(f"Error sending to Telegram: {e}")
+        logger.error(f"Error sending album to Telegram: {e}")
         return False
 
-def get_new_posts():
-    """Get new posts from Divar"""
-    sent_posts = load_sent_posts()
-    new_posts = []
+def batch_posts(posts):
+    """Group consecutive photo posts into albums of up to ALBUM_SIZE; other posts go alone"""
+    album = []
+    for post in posts:
+        if not has_photo(post):
+            if album:
+                yield album
+                album = []
+            yield [post]
+            continue
+        album.append(post)
+        if len(album) == ALBUM_SIZE:
+            yield album
+            album = []
+    if album:
+        yield album
+
+async def get_new_posts(client, full_scan=False):
+    """Get new posts from Divar, walking all MAX_PAGES pages if full_scan is set.
     
-    result = search_divar()
-    if not result:
-        return new_posts, sent_posts
+    New posts are marked seen in memory right away so later checks don't queue them
+    again; they are only persisted once delivered (see delivery_worker).
+    """
+    sent_posts = SENT_POSTS
     
-    # Process the first page
-    post_list = result.get('web_widgets', {}).get('post_list', [])
+    # Walk result pages (newest first), keeping only post rows
+    post_rows = []
+    last_post_date = None
+    for _ in range(MAX_PAGES):
+        result = await search_divar(client, last_post_date)
+        if not result:
+            break
+        
+        post_list = result.get('web_widgets', {}).get('post_list', [])
+        page_rows = [post.get('data', {}) for post in post_list if post.get('widget_type') == 'POST_ROW']
+        post_rows.extend(page_rows)
+        
+        # Once a page reaches a known post, every later page is known too;
+        # with nothing known yet (first run) stick to the first page
+        if not page_rows:
+            break
+        if not full_scan and (not sent_posts or any(token_key(data.get('token') or '') in sent_posts for data in page_rows)):
+            break
+        last_post_date = result.get('last_post_date')
+        if not last_post_date:
+            break
     
-    for post in post_list:
-        if post.get('widget_type') == 'POST_ROW':
-            data = post.get('data', {})
-            token = data.get('token')
-            
-            if token and token not in sent_posts:
-                new_posts.append(data)
-                sent_posts.add(token)
-                logger.info(f"Found new post: {data.get('title', 'No title')}")
+    # Unseen posts keyed by token_key (also drops repeats across pages), added to sent_posts after the scan
+    new_rows = {
+        key: data for data in post_rows
+        if data.get('token') and (key := token_key(data['token'])) not in sent_posts
+    }
+    new_posts = list(new_rows.values())
+    for data in new_posts:
+        logger.info(f"Found new post: {data.get('title', 'No title')}")
     
-    # Save sent posts immediately to avoid duplicates
-    if new_posts:
-        save_sent_posts(sent_posts)
+    if new_rows:
+        sent_posts.update(dict.fromkeys(new_rows))
+        trim_sent_posts(sent_posts)
     
-    return new_posts, sent_posts
+    return new_posts
+
+async def queue_new_posts(new_posts):
+    """Hand new posts to the delivery worker, oldest first so chats read chronologically"""
+    for post in reversed(new_posts):
+        UNDELIVERED_POSTS[post['token']] = post
+        await DELIVERY_QUEUE.put(post)
+
+async def seed_sent_posts(client):
+    """Record every post on the first MAX_PAGES result pages as sent, without delivering any"""
+    new_posts = await get_new_posts(client, full_scan=True)
+    PENDING_SENT_POSTS.extend(post['token'] for post in new_posts)
+    flush_sent_posts()
+    logger.info(f"Full scan: recorded {len(new_posts)} posts as sent")
+
+def mark_delivered(posts):
+    """Record posts as sent; flush_job writes them to the database"""
+    for post in posts:
+        UNDELIVERED_POSTS.pop(post['token'], None)
+        PENDING_SENT_POSTS.append(post['token'])
+
+async def send_posts(bot, posts):
+    """Send posts (oldest first) to all configured chats; returns (delivered, failed) post lists.
+    
+    Each post is marked delivered as soon as it is sent, so a restart mid-batch doesn't resend it.
+    """
+    delivered_posts, failed_posts = [], []
+    for batch in batch_posts(posts):
+        if len(batch) > 1 and await send_media_group(bot, batch, TELEGRAM_CHAT_IDS):
+            mark_delivered(batch)
+            delivered_posts.extend(batch)
+            continue
+        # A rejected album is sent post by post, so one bad photo or caption only fails its own post
+        for post in batch:
+            delivered = False
+            try:
+                delivered = await send_telegram_message(bot, post, TELEGRAM_CHAT_IDS)
+            except Exception as e:
+                logger.error(f"Error sending post: {e}")
+            if delivered:
+                mark_delivered([post])
+            (delivered_posts if delivered else failed_posts).append(post)
+    return delivered_posts, failed_posts
+
+async def delivery_worker(bot):
+    """Deliver queued posts, taking everything already waiting so photo runs can go out as albums.
+    
+    Delivered posts are persisted as sent. Failed ones are kept here and tried again after
+    DELIVERY_RETRY_DELAY (or with the next queued posts), up to MAX_DELIVERY_ATTEMPTS times;
+    after that they are persisted too, so they aren't sent again.
+    """
+    retry_posts = []
+    attempts = {}  # Failed deliveries so far, by token, for posts in retry_posts
+    while True:
+        try:
+            posts = [await asyncio.wait_for(DELIVERY_QUEUE.get(), DELIVERY_RETRY_DELAY if retry_posts else None)]
+        except asyncio.TimeoutError:
+            posts = []
+        while not DELIVERY_QUEUE.empty():
+            posts.append(DELIVERY_QUEUE.get_nowait())
+        queued = len(posts)
+        # Retried posts are older than anything newly queued
+        posts = retry_posts + posts
+        
+        delivered_posts, failed_posts = await send_posts(bot, posts)
+        for post in delivered_posts:
+            attempts.pop(post['token'], None)
+        
+        retry_posts = []
+        for post in failed_posts:
+            attempts[post['token']] = attempts.get(post['token'], 0) + 1
+            if attempts[post['token']] < MAX_DELIVERY_ATTEMPTS:
+                retry_posts.append(post)
+            else:
+                logger.error(f"Giving up on post {post['token']} after {attempts.pop(post['token'])} failed deliveries")
+                mark_delivered([post])
+        logger.info(f"Delivered {len(delivered_posts)}/{len(posts)} posts")
+        for _ in range(queued):
+            DELIVERY_QUEUE.task_done()
+
+# Static bot UI, built once
+MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Check New Posts", callback_data='check_new')],
+    [InlineKeyboardButton("ℹ️ Info", callback_data='info')]
+])
+BACK_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back')]])
+SEARCH_FILTERS_HTML = (
+    "📍 <b>Search Area:</b> Tehran\n"
+    "💰 <b>Max Price:</b> 200,000,000 Tomans\n"
+    "🏠 <b>Max Rent:</b> 13,000,000 Tomans\n"
+)
+WELCOME_TEMPLATE = (
+    "🏠 <b>Divar Post Notifier Bot</b>\n\n"
+    "👋 Welcome {name}!\n\n"
+    + SEARCH_FILTERS_HTML +
+    "\nClick the button below to check for new posts:"
+)
+INFO_HTML = SEARCH_FILTERS_HTML + f"⏰ <b>Check Interval:</b> {MIN_CHECK_INTERVAL}-{CHECK_INTERVAL} seconds\n"
+MAIN_MENU_HTML = '🏠 <b>Divar Post Notifier Bot</b>\n\nMain menu:'
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     user = update.effective_user
     
-    keyboard = [
-        [InlineKeyboardButton("🔍 Check New Posts", callback_data='check_new')],
-        [InlineKeyboardButton("ℹ️ Info", callback_data='info')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    welcome_text = (
-        "🏠 <b>Divar Post Notifier Bot</b>\n\n"
-        f"👋 Welcome {user.first_name}!\n\n"
-        "📍 <b>Search Area:</b> Tehran\n"
-        "💰 <b>Max Price:</b> 200,000,000 Tomans\n"
-        "🏠 <b>Max Rent:</b> 13,000,000 Tomans\n\n"
-        "Click the button below to check for new posts:"
-    )
-    
     await update.message.reply_text(
-        welcome_text,
-        reply_markup=reply_markup,
+        WELCOME_TEMPLATE.format(name=html.escape(user.first_name)),
+        reply_markup=MAIN_KEYBOARD,
         parse_mode='HTML'
     )
 
@@ -174,97 +547,116 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
-    main_keyboard = [
-        [InlineKeyboardButton("🔍 Check New Posts", callback_data='check_new')],
-        [InlineKeyboardButton("ℹ️ Info", callback_data='info')]
-    ]
-    
     if query.data == 'check_new':
         await query.edit_message_text(
             '🔄 Checking for new posts...',
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back')]])
+            reply_markup=BACK_KEYBOARD
         )
         
-        new_posts, sent_posts = get_new_posts()
+        new_posts = await get_new_posts(context.bot_data['http_client'])
         
         if new_posts:
-            await query.edit_message_text(
-                f'📬 Found {len(new_posts)} new posts. Sending...',
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back')]])
-            )
-            
-            sent_count = 0
-            for post in new_posts:
-                try:
-                    success = await send_telegram_message(context.bot, post, TELEGRAM_CHAT_IDS)
-                    if success:
-                        sent_count += 1
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    logger.error(f"Error sending post: {e}")
+            await queue_new_posts(new_posts)
             
             await query.edit_message_text(
-                f'✅ {sent_count} posts sent successfully.',
-                reply_markup=InlineKeyboardMarkup(main_keyboard)
+                f'📬 Found {len(new_posts)} new posts, queued for delivery.',
+                reply_markup=MAIN_KEYBOARD
             )
         else:
             await query.edit_message_text(
                 '✅ No new posts found.',
-                reply_markup=InlineKeyboardMarkup(main_keyboard)
+                reply_markup=MAIN_KEYBOARD
             )
             
     elif query.data == 'info':
-        info_text = (
-            "📍 <b>Search Area:</b> Tehran\n"
-            "💰 <b>Max Price:</b> 200,000,000 Tomans\n"
-            "🏠 <b>Max Rent:</b> 13,000,000 Tomans\n"
-            f"⏰ <b>Check Interval:</b> {CHECK_INTERVAL} seconds\n"
-        )
         await query.edit_message_text(
-            info_text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data='back')]]),
+            INFO_HTML,
+            reply_markup=BACK_KEYBOARD,
             parse_mode='HTML'
         )
         
     elif query.data == 'back':
         await query.edit_message_text(
-            '🏠 <b>Divar Post Notifier Bot</b>\n\nMain menu:',
-            reply_markup=InlineKeyboardMarkup(main_keyboard),
+            MAIN_MENU_HTML,
+            reply_markup=MAIN_KEYBOARD,
             parse_mode='HTML'
         )
 
+def next_check_interval(interval, found_new_posts):
+    """Poll faster while new posts keep arriving and back off to CHECK_INTERVAL when quiet"""
+    if found_new_posts:
+        interval //= 2
+    else:
+        interval *= 2
+    return min(CHECK_INTERVAL, max(MIN_CHECK_INTERVAL, interval))
+
 async def periodic_check(context: ContextTypes.DEFAULT_TYPE):
     """Periodic check for new posts"""
     logger.info("Starting periodic check...")
+    interval = context.job.data or CHECK_INTERVAL
+    new_posts = []
     
     try:
-        new_posts, sent_posts = get_new_posts()
+        new_posts = await get_new_posts(context.bot_data['http_client'])
         
         if new_posts:
             logger.info(f"Found {len(new_posts)} new posts")
             
-            sent_count = 0
-            for post in new_posts:
-                try:
-                    success = await send_telegram_message(context.bot, post, TELEGRAM_CHAT_IDS)
-                    if success:
-                        sent_count += 1
-                    await asyncio.sleep(1)
-                except Exception as e:
-                    logger.error(f"Error sending post in periodic check: {e}")
+            await queue_new_posts(new_posts)
             
-            logger.info(f"Periodic check completed - {sent_count} posts sent")
+            logger.info(f"Periodic check completed - {len(new_posts)} posts queued")
         else:
             logger.info("Periodic check completed - no new posts found")
     except Exception as e:
         logger.error(f"Error in periodic check: {e}")
+    finally:
+        interval = next_check_interval(interval, bool(new_posts))
+        logger.info(f"Next check in {interval} seconds")
+        context.job_queue.run_once(periodic_check, when=interval, data=interval)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors"""
     logger.error(f"Error: {context.error}")
 
+async def flush_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically flush pending sent post tokens"""
+    flush_sent_posts()
+
+async def on_startup(application: Application):
+    """Create the shared Divar HTTP client, seed the store if asked to, start the background
+    delivery and retry workers and queue posts the last run left undelivered"""
+    application.bot_data['http_client'] = create_http_client()
+    if FULL_SCAN:
+        await seed_sent_posts(application.bot_data['http_client'])
+    application.bot_data['workers'] = [
+        asyncio.create_task(delivery_worker(application.bot)),
+        asyncio.create_task(retry_worker())
+    ]
+    for post in list(UNDELIVERED_POSTS.values()):
+        await DELIVERY_QUEUE.put(post)
+
+async def on_shutdown(application: Application):
+    """Stop the workers, save sent and undelivered posts and close the database and shared Divar HTTP client"""
+    workers = application.bot_data['workers'] + list(RETRY_TASKS)
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    flush_sent_posts()
+    save_undelivered_posts()
+    DB.close()
+    await application.bot_data['http_client'].aclose()
+
 def main():
     """Main function"""
+    global FULL_SCAN, DB
+    parser = argparse.ArgumentParser(description="Divar post notifier bot")
+    parser.add_argument(
+        '--full-scan',
+        action='store_true',
+        help=f"record every post on the first {MAX_PAGES} result pages as sent at startup, without sending them (for seeding)"
+    )
+    FULL_SCAN = FULL_SCAN or parser.parse_args().full_scan
+    
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN is required")
         return
@@ -274,20 +666,55 @@ def main():
         return
     
     logger.info("Starting Divar Bot...")
+    try:
+        DB = sqlite3.connect(SENT_POSTS_DB)
+    except sqlite3.Error as e:
+        logger.error(f"Cannot open {SENT_POSTS_DB}: {e}")
+        return
+    SENT_POSTS.update(load_sent_posts())
+    for post in load_undelivered_posts():
+        UNDELIVERED_POSTS[post['token']] = post
+        SENT_POSTS[token_key(post['token'])] = None
+    logger.info(f"Known posts: {len(SENT_POSTS)}")
     logger.info(f"Users: {len(TELEGRAM_CHAT_IDS)}")
-    logger.info(f"Check interval: {CHECK_INTERVAL} seconds")
+    logger.info(f"Check interval: {MIN_CHECK_INTERVAL}-{CHECK_INTERVAL} seconds")
+    if FULL_SCAN:
+        logger.info(f"Full scan enabled: seeding from up to {MAX_PAGES} pages at startup")
     
     # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Telegram rate limits: ~30 messages/second overall, 20 messages/minute per group
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=30,
+        overall_time_period=1,
+        group_max_rate=20,
+        group_time_period=60
+    )
+    application = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .rate_limiter(rate_limiter)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
-    application.add_handler(CallbackQueryHandler(button_handler))
+    # Run button callbacks as tasks so a check in progress doesn't hold up other updates
+    application.add_handler(CallbackQueryHandler(button_handler, block=False))
     application.add_error_handler(error_handler)
     
     # Setup periodic job
     job_queue = application.job_queue
-    job_queue.run_repeating(periodic_check, interval=CHECK_INTERVAL, first=10)
+    job_queue.run_once(periodic_check, when=10, data=CHECK_INTERVAL)
+    job_queue.run_repeating(flush_job, interval=SENT_POSTS_FLUSH_INTERVAL)
+    
+    # Use uvloop's faster event loop when available (it doesn't support Windows)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
     
     # Start bot
     logger.info("Bot is running...")